@@ -1,15 +1,37 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.routing import APIRoute
 from fastapi.middleware.httpsredirect import HTTPSRedirectMiddleware
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
-from pydantic import BaseModel
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, StringConstraints
+from typing import Annotated, Literal
+from typing_extensions import TypedDict
+from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS, TfidfVectorizer
 from pathlib import Path
-import os, requests
+from functools import lru_cache
+from cachetools import TTLCache
+import numpy as np
+import os, re, asyncio, hashlib, httpx, orjson
+
+class ORJSONRequest(Request):
+    async def json(self):
+        if not hasattr(self, "_json"):
+            self._json = orjson.loads(await self.body())
+        return self._json
+
+class ORJSONRoute(APIRoute):
+    """Route that decodes JSON request bodies with orjson."""
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def route_handler(request: Request):
+            return await handler(ORJSONRequest(request.scope, request.receive))
+
+        return route_handler
 
 app = FastAPI()
+app.router.route_class = ORJSONRoute
 app.add_middleware(HTTPSRedirectMiddleware)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
@@ -24,38 +46,122 @@ app.add_middleware(
 # === Model Setup ===
 TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY")
 MODEL = "mistralai/Mixtral-8x7B-Instruct-v0.1"
+TOGETHER_URL = "https://api.together.xyz/v1/chat/completions"
+# Char n-gram scores for short on-topic queries ("pay", "login", "how do I pay")
+# sit around 0.1-0.2, so only near-zero matches get the canned redirect
+FAQ_MIN_SCORE = float(os.getenv("FAQ_MIN_SCORE", "0.1"))
+# First-turn FAQ matches at or above this score are answered without the LLM.
+# Paraphrases of a FAQ question ("who is the ceo", "how do i reset my password")
+# score 0.75-0.95, but so do same-shaped questions about other companies ("who
+# is the ceo of tesla" 0.84), so the score alone never decides a direct answer.
+FAQ_ANSWER_THRESHOLD = float(os.getenv("FAQ_ANSWER_THRESHOLD", "0.75"))
+# Messages much longer than the matched question carry a follow-up the stored
+# answer doesn't cover ("How to reset password? I did it and got error 500")
+FAQ_ANSWER_MAX_LENGTH_RATIO = 1.5
+TOGETHER_HEADERS = {
+    "Authorization": f"Bearer {TOGETHER_API_KEY}",
+    "Content-Type": "application/json"
+}
+
+# Shared async client so upstream connections (and TLS sessions) are reused.
+# Uses the default transport so HTTP(S)_PROXY from the environment still applies.
+client = httpx.AsyncClient(
+    http2=True,
+    timeout=60,
+    limits=httpx.Limits(max_keepalive_connections=100, max_connections=200),
+)
+
+# Transient upstream failures retried before anything is streamed to the client
+UPSTREAM_RETRIES = 2
+RETRY_BACKOFF = 0.2
+RETRY_STATUSES = {429, 502, 503, 504}
 
-class Message(BaseModel):
-    role: str
-    content: str
+@app.on_event("shutdown")
+async def close_client():
+    await client.aclose()
+
+SYSTEM_PREFIX = (
+    "You are Zendawa Assistant, a helpful AI designed to support users with accurate and friendly information "
+    "about Zendawa — a Kenyan telepharmacy platform offering services like drug ordering, pharmacy onboarding, "
+    "teleconsultations, and healthcare logistics.\n\n"
+    "If a question falls outside Zendawa’s scope (e.g., about cars, sports, or unrelated topics), kindly guide "
+    "the user with a gentle message like:\n"
+    "“I'm here to help with questions related to Zendawa’s telepharmacy services. Feel free to ask anything "
+    "about our platform or healthcare-related support.”\n\n"
+    "To assist you better, here’s the most relevant information from Zendawa’s FAQ:\n"
+)
+
+# Plain dicts validated by pydantic-core; they go into the upstream payload as-is
+# Caps bound request size and the memory held by the per-message match cache
+MAX_MESSAGES = 50
+MAX_CONTENT_CHARS = 4000
+
+class Message(TypedDict):
+    role: Literal["system", "user", "assistant"]
+    content: Annotated[str, StringConstraints(max_length=MAX_CONTENT_CHARS)]
 
 class ChatRequest(BaseModel):
-    messages: list[Message]
+    messages: list[Message] = Field(min_length=1, max_length=MAX_MESSAGES)
 
 # === Load FAQ Data ===
 faq_path = "documents/zendawa_faq.txt"
-with open(faq_path, "r", encoding="utf-8") as f:
-    raw_faq_blocks = f.read().strip().split("\n\n")
+with open(faq_path, "rb") as f:
+    raw_faq_blocks = f.read().strip().split(b"\n\n")
 
+# Single pass per block; only the kept Q/A substrings are decoded
 faq_pairs = []
 for block in raw_faq_blocks:
-    lines = block.strip().split("\n")
-    q = next((line[3:] for line in lines if line.lower().startswith("q:")), None)
-    a = next((line[3:] for line in lines if line.lower().startswith("a:")), None)
+    q = a = None
+    for line in block.strip().split(b"\n"):
+        head = line[:2].lower()
+        if head == b"q:" and q is None:
+            q = line[3:].decode("utf-8").strip()
+        elif head == b"a:" and a is None:
+            a = line[3:].decode("utf-8").strip()
     if q and a:
-        faq_pairs.append((q.strip(), a.strip()))
+        faq_pairs.append((q, a))
 
 questions = [q for q, a in faq_pairs]
 answers = [a for q, a in faq_pairs]
-vectorizer = TfidfVectorizer().fit(questions)
-question_vectors = vectorizer.transform(questions)
+
+# Same token pattern as the vectorizer's word analyzer
+_WORD_RE = re.compile(r"(?u)\b\w\w+\b")
+
+def _content_words(text: str) -> frozenset:
+    return frozenset(_WORD_RE.findall(text.lower())) - ENGLISH_STOP_WORDS
+
+# A direct FAQ answer needs every content word of the message to appear in the
+# matched question, so "who is the ceo of safaricom" still goes to the LLM
+question_words = [_content_words(q) for q in questions]
+vectorizer = TfidfVectorizer(
+    dtype=np.float32,
+    sublinear_tf=True,
+    norm="l2",
+    analyzer="char_wb",
+    ngram_range=(3, 5),
+    min_df=1,
+    max_features=50000,
+).fit(questions)
+# The FAQ is small, so a dense matrix lets each query be one BLAS sgemv.
+# Rows are already unit-norm float32 (norm="l2", dtype=np.float32).
+question_vectors = vectorizer.transform(questions).toarray()
+
+# vectorizer and FAQ data are fixed after startup, so repeat queries can be memoized
+@lru_cache(maxsize=4096)
+def _best(msg: str):
+    sims = question_vectors @ vectorizer.transform([msg]).toarray().ravel()
+    best_idx = int(sims.argmax())
+    return best_idx, float(sims[best_idx])
+
+# Generated first-turn replies, keyed by (matched FAQ index, message hash)
+_reply_cache = TTLCache(maxsize=10_000, ttl=3600)
 
 @app.post("/chat")
 async def chat(chat_req: ChatRequest):
     if not TOGETHER_API_KEY:
         raise HTTPException(status_code=500, detail="Missing Together.ai API key")
 
-    user_msg = chat_req.messages[-1].content.strip()
+    user_msg = chat_req.messages[-1]["content"].strip()
     low = user_msg.lower()
 
     # ——— Handle “Order drugs” intent ————————————————
@@ -98,11 +204,9 @@ async def chat(chat_req: ChatRequest):
                 return {"reply": name_responses[name]}
 
     # ——— Otherwise, use FAQ + LLM fallback ——————————————
-    user_vector = vectorizer.transform([user_msg])
-    sims = cosine_similarity(user_vector, question_vectors)[0]
-    best_idx = int(sims.argmax())
+    best_idx, best_score = _best(user_msg)
 
-    if sims[best_idx] < 0.3:
+    if best_score < FAQ_MIN_SCORE:
         return {
             "reply": (
                 "I'm here to help with Zendawa’s telepharmacy services. "
@@ -110,37 +214,89 @@ async def chat(chat_req: ChatRequest):
             )
         }
 
+    first_turn = len(chat_req.messages) == 1
+    if (
+        first_turn
+        and best_score >= FAQ_ANSWER_THRESHOLD
+        and len(user_msg) <= FAQ_ANSWER_MAX_LENGTH_RATIO * len(questions[best_idx])
+        and _content_words(user_msg) <= question_words[best_idx]
+    ):
+        return {"reply": answers[best_idx]}
+
+    # Only first turns are cached; later turns depend on the conversation history
+    cache_key = None
+    if first_turn:
+        cache_key = (best_idx, hashlib.blake2b(low.encode(), digest_size=16).digest())
+        if cache_key in _reply_cache:
+            return {"reply": _reply_cache[cache_key]}
+
     matched_q = questions[best_idx]
     matched_a = answers[best_idx]
 
-    system_prompt = (
-        "You are Zendawa Assistant, a helpful AI designed to support users with accurate and friendly information "
-        "about Zendawa — a Kenyan telepharmacy platform offering services like drug ordering, pharmacy onboarding, "
-        "teleconsultations, and healthcare logistics.\n\n"
-        "If a question falls outside Zendawa’s scope (e.g., about cars, sports, or unrelated topics), kindly guide "
-        "the user with a gentle message like:\n"
-        "“I'm here to help with questions related to Zendawa’s telepharmacy services. Feel free to ask anything "
-        "about our platform or healthcare-related support.”\n\n"
-        f"To assist you better, here’s the most relevant information from Zendawa’s FAQ:\nQ: {matched_q}\nA: {matched_a}"
-    )
-
-    prompt_messages = [{"role": "system", "content": system_prompt}] + [msg.dict() for msg in chat_req.messages]
-    payload = {"model": MODEL, "messages": prompt_messages}
-    headers = {
-        "Authorization": f"Bearer {TOGETHER_API_KEY}",
-        "Content-Type": "application/json"
-    }
+    system_prompt = SYSTEM_PREFIX + "Q: " + matched_q + "\nA: " + matched_a
+
+    prompt_messages = [{"role": "system", "content": system_prompt}] + chat_req.messages
+    payload = {"model": MODEL, "messages": prompt_messages, "stream": True}
+    return StreamingResponse(stream_reply(payload, cache_key), media_type="text/plain; charset=utf-8")
+
+async def send_with_retries(request: httpx.Request) -> httpx.Response:
+    """Send ``request`` as a stream, retrying failed connects and retryable statuses."""
+    for attempt in range(UPSTREAM_RETRIES + 1):
+        last = attempt == UPSTREAM_RETRIES
+        try:
+            response = await client.send(request, stream=True)
+        except (httpx.ConnectError, httpx.ConnectTimeout):
+            if last:
+                raise
+        else:
+            if last or response.status_code not in RETRY_STATUSES:
+                return response
+            await response.aclose()
+        await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+async def stream_reply(payload: dict, cache_key: tuple | None = None):
+    """Relay the Together.ai SSE completion to the client as plain-text deltas.
+
+    A completed reply is stored in the reply cache under ``cache_key``, if given.
+    """
+    parts = []
+
+    request = client.build_request("POST", TOGETHER_URL, content=orjson.dumps(payload), headers=TOGETHER_HEADERS)
 
     try:
-        response = requests.post("https://api.together.xyz/v1/chat/completions", json=payload, headers=headers)
-        response.raise_for_status()
-        data = response.json()
-        reply = data.get("choices", [{}])[0].get("message", {}).get("content", "Sorry, I don't have that info.")
-        return {"reply": reply}
+        response = await send_with_retries(request)
+        try:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                delta = orjson.loads(data).get("choices", [{}])[0].get("delta", {}).get("content")
+                if delta:
+                    parts.append(delta)
+                    yield delta
+        finally:
+            await response.aclose()
+        if not parts:
+            yield "Sorry, I don't have that info."
+        elif cache_key is not None:
+            _reply_cache[cache_key] = "".join(parts)
     except Exception as e:
         print("❌ Error:", e)
-        return {"reply": "Sorry, I could not retrieve a response. Please try again later."}
+        # After a partial reply, just end the stream rather than gluing the
+        # apology onto text the UI keeps in its history
+        if not parts:
+            yield "Sorry, I could not retrieve a response. Please try again later."
+
+# === UI ===
+INDEX_HTML = Path("static/index.html").read_bytes()
+INDEX_ETAG = '"' + hashlib.md5(INDEX_HTML).hexdigest() + '"'
+INDEX_HEADERS = {"ETag": INDEX_ETAG, "Cache-Control": "public, max-age=60"}
 
-@app.get("/", response_class=HTMLResponse)
-def get_ui():
-    return Path("static/index.html").read_text()
+@app.get("/")
+def get_ui(request: Request):
+    if request.headers.get("if-none-match") == INDEX_ETAG:
+        return Response(status_code=304, headers=INDEX_HEADERS)
+    return Response(content=INDEX_HTML, media_type="text/html", headers=INDEX_HEADERS)
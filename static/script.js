@@ -18,8 +18,12 @@ async function sendMessage() {
     body: JSON.stringify({ messages: history })
   });
 
-  const data = await res.json();
-  appendMessage("bot", data.reply);
+  if ((res.headers.get("content-type") || "").startsWith("application/json")) {
+    const data = await res.json();
+    appendMessage("bot", data.reply);
+  } else {
+    appendMessage("bot", await res.text());
+  }
 }
 
 function appendMessage(role, text) {